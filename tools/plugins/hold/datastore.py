@@ -1,85 +1,347 @@
+import math
+import threading
+from dataclasses import dataclass
 from enum import Enum
+from time import monotonic
 from typing import Any
 
 from pyln.client import Plugin, RpcError
 
 from plugins.hold.consts import PLUGIN_NAME
-from plugins.hold.invoice import HoldInvoice
+from plugins.hold.invoice import HoldInvoice, InvoiceState
+from plugins.hold.rpc_pool import RpcPool
 from plugins.hold.settler import Settler
+from plugins.hold.utils import json_dumps
 
 
 class DataErrorCodes(int, Enum):
     KeyDoesNotExist = 1200
     KeyExists = 1202
+    UpdateKeyDoesNotExist = 1203
+
+
+@dataclass(slots=True)
+class WriteFailure:
+    attempts: int
+    retry_at: float
 
 
 class DataStore:
     _plugin: Plugin
     _settler: Settler
+    _rpc_pool: RpcPool
     _invoices_key = "invoices"
 
-    def __init__(self, plugin: Plugin, settler: Settler) -> None:
+    # The datastore is only read once on startup; afterward, this index is the
+    # source of truth for reads and every write goes to both
+    _lock: threading.RLock
+    _invoices: dict[str, HoldInvoice]
+
+    # Dict representations of the invoices as of their last save; all listings
+    # (the listholdinvoices RPC and gRPC) read these so that they agree with each other
+    # and never see an invoice in the middle of being updated
+    _invoice_dicts: dict[str, dict[str, Any]]
+
+    # Updates of existing invoices are written in the background; when an invoice
+    # is updated multiple times between two flushes, only its latest state is written
+    _flush_interval = 0.05
+    _dirty: dict[str, dict[str, Any]]
+    _flush_lock: threading.Lock
+    _flush_thread: threading.Thread
+    _stop_flush: threading.Event
+
+    # Failed updates are retried in the background with an exponential backoff; after
+    # the last attempt, they are only written by explicit flushes and on shutdown
+    _retry_delay = 1
+    _max_write_attempts = 10
+    _write_failures: dict[str, WriteFailure]
+
+    def __init__(self, plugin: Plugin, settler: Settler, rpc_pool: RpcPool) -> None:
         self._plugin = plugin
         self._settler = settler
+        self._rpc_pool = rpc_pool
 
-    def save_invoice(self, invoice: HoldInvoice, mode: str = "must-create") -> None:
-        self._plugin.rpc.datastore(
-            key=[PLUGIN_NAME, DataStore._invoices_key, invoice.payment_hash],
-            string=invoice.to_json(),
-            mode=mode,
-        )
+        self._lock = threading.RLock()
+        self._invoices = {}
+        self._invoice_dicts = {}
 
-    def list_invoices(self, payment_hash: str | None) -> list[HoldInvoice]:
-        key = [PLUGIN_NAME, DataStore._invoices_key]
-        if payment_hash is not None:
-            key.append(payment_hash)
+        self._dirty = {}
+        self._write_failures = {}
+        self._flush_lock = threading.Lock()
+        self._start_flush_interval()
 
-        return self._parse_invoices(
+    def init(self) -> None:
+        invoices = self._parse_invoices(
             self._plugin.rpc.listdatastore(
-                key=key,
+                key=[PLUGIN_NAME, DataStore._invoices_key],
             )
         )
 
-    def get_invoice(self, payment_hash: str) -> HoldInvoice | None:
-        invoices = self.list_invoices(payment_hash)
-        if len(invoices) == 0:
-            return None
+        with self._lock:
+            self._invoices = {invoice.payment_hash: invoice for invoice in invoices}
+            self._invoice_dicts = {invoice.payment_hash: invoice.to_dict() for invoice in invoices}
 
-        return invoices[0]
+    def stop(self) -> None:
+        self._stop_flush.set()
+        self._flush_thread.join()
 
-    def delete_invoice(self, payment_hash: str) -> bool:
+        # Shutting down must not be stopped by a write that fails
         try:
-            self._plugin.rpc.deldatastore(
-                [PLUGIN_NAME, DataStore._invoices_key, payment_hash],
-            )
-        except RpcError as e:
-            # noinspection PyTypeChecker
-            if e.error["code"] == DataErrorCodes.KeyDoesNotExist:
-                return False
+            self.flush()
+        except Exception as e:
+            self._plugin.log(f"Could not write hold invoices on shutdown: {e}", level="error")
+
+    def save_invoice(self, invoice: HoldInvoice, mode: str = "must-create") -> None:
+        invoice_dict = invoice.to_dict()
+
+        # Creations are written right away to detect duplicates
+        if mode != "must-replace":
+            self._plugin.rpc.datastore(**DataStore._datastore_payload(invoice_dict, mode))
 
-            raise
+        with self._lock:
+            # Updates of invoices that were deleted in the meantime are dropped,
+            # so that they do not show up in the index again
+            if mode == "must-replace" and self._invoices.get(invoice.payment_hash) is not invoice:
+                return
 
-        return True
+            self._invoices[invoice.payment_hash] = invoice
+            self._invoice_dicts[invoice.payment_hash] = invoice_dict
+
+            if mode == "must-replace":
+                self._dirty[invoice.payment_hash] = invoice_dict
+
+    def flush(self, payment_hash: str | None = None) -> None:
+        error = self._flush(payment_hash)
+        if error is not None:
+            raise error
+
+    def list_invoice_dicts(self, payment_hash: str | None) -> list[dict[str, Any]]:
+        with self._lock:
+            if payment_hash is None:
+                return list(self._invoice_dicts.values())
+
+            invoice_dict = self._invoice_dicts.get(payment_hash)
+
+        return [invoice_dict] if invoice_dict is not None else []
+
+    def get_invoice(self, payment_hash: str) -> HoldInvoice | None:
+        with self._lock:
+            return self._invoices.get(payment_hash)
+
+    def delete_invoice(self, payment_hash: str) -> bool:
+        # Holding the flush lock makes sure no pending update is written after the deletion
+        with self._flush_lock:
+            try:
+                self._plugin.rpc.deldatastore(
+                    [PLUGIN_NAME, DataStore._invoices_key, payment_hash],
+                )
+            except RpcError as e:
+                # noinspection PyTypeChecker
+                if e.error["code"] != DataErrorCodes.KeyDoesNotExist:
+                    raise
+
+                deleted = False
+            else:
+                deleted = True
+
+            with self._lock:
+                self._invoices.pop(payment_hash, None)
+                self._invoice_dicts.pop(payment_hash, None)
+                self._dirty.pop(payment_hash, None)
+                self._write_failures.pop(payment_hash, None)
+
+        return deleted
 
     def settle_invoice(self, invoice: HoldInvoice, preimage: str) -> None:
+        # Settling or cancelling an invoice that is in that state already changes nothing,
+        # but an earlier attempt might not have been written yet
+        if invoice.state == InvoiceState.Paid:
+            self.flush(invoice.payment_hash)
+            return
+
+        # Checked before the preimage is set or any HTLC is resolved,
+        # so that an illegal transition leaves the invoice untouched
+        invoice.check_state_transition(InvoiceState.Paid)
+
         # TODO: save in the normal invoice table of CLN
         invoice.payment_preimage = preimage
         self._settler.settle(invoice)
         self.save_invoice(invoice, mode="must-replace")
+        self.flush(invoice.payment_hash)
 
     def cancel_invoice(self, invoice: HoldInvoice) -> None:
+        if invoice.state == InvoiceState.Cancelled:
+            self.flush(invoice.payment_hash)
+            return
+
+        invoice.check_state_transition(InvoiceState.Cancelled)
+
         self._settler.cancel(invoice)
         self.save_invoice(invoice, mode="must-replace")
+        self.flush(invoice.payment_hash)
 
     def delete_invoices(self) -> int:
         key = [PLUGIN_NAME, DataStore._invoices_key]
-        invoices = self._plugin.rpc.listdatastore(key=key)["datastore"]
-        for invoice in invoices:
+
+        with self._flush_lock:
+            invoices = self._plugin.rpc.listdatastore(key=key)["datastore"]
+
             # TODO: also cancel?
-            self._plugin.rpc.deldatastore(invoice["key"])
+            deletions = [
+                (
+                    invoice["key"][-1],
+                    self._rpc_pool.submit("deldatastore", {"key": invoice["key"]}),
+                )
+                for invoice in invoices
+            ]
+
+            # When some deletions fail, the ones that succeeded are still dropped
+            # from the index before the first error is raised
+            deleted, error = [], None
+            for payment_hash, future in deletions:
+                try:
+                    future.result()
+                except RpcError as e:
+                    # Invoices that were deleted in the meantime count as deleted
+                    # noinspection PyTypeChecker
+                    if e.error["code"] != DataErrorCodes.KeyDoesNotExist:
+                        error = error or e
+                        continue
+                except Exception as e:
+                    error = error or e
+                    continue
+
+                deleted.append(payment_hash)
+
+            with self._lock:
+                for payment_hash in deleted:
+                    self._invoices.pop(payment_hash, None)
+                    self._invoice_dicts.pop(payment_hash, None)
+                    self._dirty.pop(payment_hash, None)
+                    self._write_failures.pop(payment_hash, None)
+
+        if error is not None:
+            raise error
 
         return len(invoices)
 
+    def _start_flush_interval(self) -> None:
+        self._stop_flush = threading.Event()
+
+        def loop() -> None:
+            while not self._stop_flush.wait(DataStore._flush_interval):
+                # Failed writes are logged per invoice
+                try:
+                    self._flush(None, due_only=True)
+                except Exception as e:  # noqa: PERF203
+                    self._plugin.log(f"Could not write hold invoices: {e}", level="warn")
+
+        self._flush_thread = threading.Thread(target=loop)
+        self._flush_thread.start()
+
+    def _flush(self, payment_hash: str | None, due_only: bool = False) -> Exception | None:
+        with self._flush_lock:
+            with self._lock:
+                dirty = self._pop_dirty(payment_hash, due_only)
+
+            writes = [
+                (
+                    invoice_dict,
+                    self._rpc_pool.submit(
+                        "datastore",
+                        DataStore._datastore_payload(invoice_dict, "must-replace"),
+                    ),
+                )
+                for invoice_dict in dirty
+            ]
+
+            # Failed updates are queued again before the flush lock is released, so a flush
+            # waiting for the lock retries them and reports when they fail again
+            error = None
+            for invoice_dict, future in writes:
+                try:
+                    future.result()
+                except Exception as e:  # noqa: PERF203
+                    error = error or e
+                    self._write_failed(invoice_dict, e)
+                else:
+                    if len(self._write_failures) > 0:
+                        with self._lock:
+                            self._write_failures.pop(invoice_dict["payment_hash"], None)
+
+        return error
+
+    def _pop_dirty(self, payment_hash: str | None, due_only: bool) -> list[dict[str, Any]]:
+        if payment_hash is not None:
+            invoice_dict = self._dirty.pop(payment_hash, None)
+            return [invoice_dict] if invoice_dict is not None else []
+
+        if not due_only or len(self._write_failures) == 0:
+            dirty = list(self._dirty.values())
+            self._dirty.clear()
+            return dirty
+
+        now = monotonic()
+        due = [
+            payment_hash
+            for payment_hash in self._dirty
+            if payment_hash not in self._write_failures
+            or self._write_failures[payment_hash].retry_at <= now
+        ]
+        return [self._dirty.pop(payment_hash) for payment_hash in due]
+
+    def _write_failed(self, invoice_dict: dict[str, Any], error: Exception) -> None:
+        payment_hash = invoice_dict["payment_hash"]
+
+        # The key was deleted without going through the plugin, so retrying cannot succeed
+        if (
+            isinstance(error, RpcError)
+            and error.error["code"] == DataErrorCodes.UpdateKeyDoesNotExist
+        ):
+            with self._lock:
+                self._write_failures.pop(payment_hash, None)
+
+            self._plugin.log(
+                f"Dropped update of hold invoice {payment_hash} that is not in the datastore",
+                level="warn",
+            )
+            return
+
+        with self._lock:
+            failure = self._write_failures.setdefault(payment_hash, WriteFailure(0, 0))
+            failure.attempts += 1
+            failure.retry_at = (
+                monotonic() + DataStore._retry_delay * 2 ** (failure.attempts - 1)
+                if failure.attempts < DataStore._max_write_attempts
+                else math.inf
+            )
+
+            # Unless the invoice was deleted or updated again in the meantime
+            if payment_hash in self._invoices:
+                self._dirty.setdefault(payment_hash, invoice_dict)
+
+        # Logged once when the invoice starts failing and once when retrying stops,
+        # rather than on every attempt
+        if failure.attempts == 1:
+            self._plugin.log(
+                f"Could not write hold invoice {payment_hash}; retrying: {error}",
+                level="warn",
+            )
+        elif failure.attempts == DataStore._max_write_attempts:
+            self._plugin.log(
+                f"Stopped retrying to write hold invoice {payment_hash} "
+                f"after {failure.attempts} attempts: {error}",
+                level="error",
+            )
+
+    @staticmethod
+    def _datastore_payload(invoice_dict: dict[str, Any], mode: str) -> dict[str, Any]:
+        return {
+            "key": [PLUGIN_NAME, DataStore._invoices_key, invoice_dict["payment_hash"]],
+            "string": json_dumps(invoice_dict),
+            "mode": mode,
+        }
+
     @staticmethod
     def _parse_invoices(data: dict[str, Any]) -> list[HoldInvoice]:
         return [HoldInvoice.from_json(i["string"]) for i in data["datastore"]]
@@ -26,6 +26,8 @@ POSSIBLE_STATE_TRANSITIONS = {
         InvoiceState.Cancelled,
         InvoiceState.Paid,
         InvoiceState.Accepted,
+        # When an HTLC that completed the payment has to be failed after all
+        InvoiceState.Unpaid,
     ],
     InvoiceState.Unpaid: [InvoiceState.Accepted, InvoiceState.Cancelled],
 }
@@ -18,3 +18,7 @@ class Errors:
         "code": 2104,
         "message": "invalid payment hash length",
     }
+    invalid_payment_preimage_length: ClassVar[dict[str, Any]] = {
+        "code": 2105,
+        "message": "invalid payment preimage length",
+    }
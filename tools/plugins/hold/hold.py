@@ -1,14 +1,16 @@
 import hashlib
+from typing import Any
 
 from bolt11.types import RouteHint
 from pyln.client import Plugin, RpcError
 
 from plugins.hold.datastore import DataErrorCodes, DataStore
-from plugins.hold.encoder import Encoder
+from plugins.hold.encoder import Encoder, get_payment_secret
 from plugins.hold.htlc_handler import HtlcHandler
 from plugins.hold.invoice import HoldInvoice, Htlcs, InvoiceState
 from plugins.hold.route_hints import RouteHints
 from plugins.hold.router import Router
+from plugins.hold.rpc_pool import RpcPool
 from plugins.hold.settler import Settler
 from plugins.hold.tracker import Tracker
 from plugins.hold.utils import time_now
@@ -26,6 +28,10 @@ class InvalidPaymentHashLengthError(Exception):
     pass
 
 
+class InvalidPaymentPreimageLengthError(Exception):
+    pass
+
+
 class Hold:
     def __init__(self, plugin: Plugin) -> None:
         self._plugin = plugin
@@ -33,15 +39,22 @@ class Hold:
         self._settler = Settler(self.tracker)
         self._encoder = Encoder(plugin)
         self._route_hints = RouteHints(plugin)
+        self._rpc_pool = RpcPool(plugin)
 
         self.router = Router(plugin)
-        self.ds = DataStore(plugin, self._settler)
+        self.ds = DataStore(plugin, self._settler, self._rpc_pool)
         self.handler = HtlcHandler(plugin, self.ds, self._settler, self.tracker)
 
     def init(self) -> None:
+        self.ds.init()
         self.handler.init()
         self._encoder.init()
 
+    def stop(self) -> None:
+        self.handler.stop()
+        self.ds.stop()
+        self._rpc_pool.stop()
+
     def invoice(
         self,
         payment_hash: str,
@@ -54,15 +67,26 @@ class Hold:
         if len(payment_hash) != 64:
             raise InvalidPaymentHashLengthError
 
-        if len(self._plugin.rpc.listinvoices(payment_hash=payment_hash)["invoices"]) > 0:
+        # Hold invoices are looked up in memory; only regular invoices require the RPC
+        if self.ds.get_invoice(payment_hash) is not None:
             raise InvoiceExistsError
 
+        # Checked while the invoice is encoded and signed to save a round trip
+        existing_invoices = self._rpc_pool.submit(
+            "listinvoices",
+            {
+                "payment_hash": payment_hash,
+            },
+        )
+
+        payment_secret = get_payment_secret(None)
         bolt11 = self._encoder.encode(
             payment_hash,
             amount_msat,
             description,
             expiry,
             min_final_cltv_expiry,
+            payment_secret=payment_secret,
             route_hints=route_hints,
         )
         signed = self._plugin.rpc.call(
@@ -72,11 +96,16 @@ class Hold:
             },
         )["bolt11"]
 
+        if len(existing_invoices.result()["invoices"]) > 0:
+            raise InvoiceExistsError
+
         try:
             hi = HoldInvoice(
                 state=InvoiceState.Unpaid,
                 bolt11=signed,
                 amount_msat=amount_msat,
+                min_final_cltv_expiry=min_final_cltv_expiry,
+                payment_secret=payment_secret,
                 payment_hash=payment_hash,
                 payment_preimage=None,
                 htlcs=Htlcs(),
@@ -95,31 +124,47 @@ class Hold:
         return signed
 
     def settle(self, payment_preimage: str) -> None:
-        payment_hash = hashlib.sha256(bytes.fromhex(payment_preimage)).hexdigest()
-        invoice = self.ds.get_invoice(payment_hash)
-        if invoice is None:
-            raise NoSuchInvoiceError
+        preimage = bytes.fromhex(payment_preimage)
+        if len(preimage) != 32:
+            raise InvalidPaymentPreimageLengthError
+
+        payment_hash = hashlib.sha256(preimage).hexdigest()
+
+        # Invoices are shared with the HTLC handler, so they are only mutated under its locks
+        with self.handler.lock(payment_hash):
+            invoice = self.ds.get_invoice(payment_hash)
+            if invoice is None:
+                raise NoSuchInvoiceError
+
+            self.ds.settle_invoice(invoice, payment_preimage)
 
-        self.ds.settle_invoice(invoice, payment_preimage)
         self._plugin.log(f"Settled hold invoice {payment_hash}")
 
     def cancel(self, payment_hash: str) -> None:
-        invoice = self.ds.get_invoice(payment_hash)
-        if invoice is None:
-            raise NoSuchInvoiceError
+        with self.handler.lock(payment_hash):
+            invoice = self.ds.get_invoice(payment_hash)
+            if invoice is None:
+                raise NoSuchInvoiceError
+
+            self.ds.cancel_invoice(invoice)
 
-        self.ds.cancel_invoice(invoice)
         self._plugin.log(f"Cancelled hold invoice {payment_hash}")
 
-    def list_invoices(self, payment_hash: str | None) -> list[HoldInvoice]:
-        return self.ds.list_invoices(None if payment_hash == "" else payment_hash)
+    def list_invoice_dicts(self, payment_hash: str | None) -> list[dict[str, Any]]:
+        return self.ds.list_invoice_dicts(None if payment_hash == "" else payment_hash)
 
     def wipe(self, payment_hash: str | None) -> int:
+        # Taking the locks of the HTLC handler makes sure no HTLC worker or timeout
+        # sweep is updating an invoice while it is deleted
         if payment_hash is None or payment_hash == "":
             self._plugin.log("Deleting all hold invoices", level="warn")
-            return self.ds.delete_invoices()
+            with self.handler.lock_all():
+                return self.ds.delete_invoices()
+
+        with self.handler.lock(payment_hash):
+            deleted = self.ds.delete_invoice(payment_hash)
 
-        if self.ds.delete_invoice(payment_hash):
+        if deleted:
             self._plugin.log(f"Deleted hold invoice {payment_hash}", level="warn")
             return 1
 
@@ -1,5 +1,10 @@
+import contextlib
+import heapq
 import threading
-from typing import Any, Callable
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any
 from urllib.request import Request
 
 from pyln.client import Plugin
@@ -16,10 +21,22 @@ from plugins.hold.enums import HtlcState
 from plugins.hold.invoice import HoldInvoice, Htlc, InvoiceState
 from plugins.hold.settler import HtlcFailureMessage, Settler
 from plugins.hold.tracker import Tracker
+from plugins.hold.utils import time_now
 
 
 class HtlcHandler:
-    lock = threading.Lock()
+    # Invoices with different payment hashes are handled concurrently;
+    # a fixed number of locks is shared among the payment hashes
+    _lock_shards = 64
+    _locks: list[threading.Lock]
+
+    # HTLCs are handled by a pool of workers to not block the hook dispatch
+    _htlc_workers = 32
+    _executor: ThreadPoolExecutor
+
+    # Min-heap of the times at which pending HTLCs expire and their payment hashes
+    _expiries: list[tuple[datetime, str]]
+    _expiries_lock: threading.Lock
 
     _interval_thread: threading.Thread
     _stop_timeout_interval: threading.Event
@@ -34,6 +51,13 @@ class HtlcHandler:
         self._settler = settler
         self._tracker = tracker
         self._timeout = TIMEOUT_CANCEL
+        self._locks = [threading.Lock() for _ in range(HtlcHandler._lock_shards)]
+        self._executor = ThreadPoolExecutor(
+            max_workers=HtlcHandler._htlc_workers,
+            thread_name_prefix="htlc",
+        )
+        self._expiries = []
+        self._expiries_lock = threading.Lock()
 
         self._start_timeout_interval()
 
@@ -45,10 +69,46 @@ class HtlcHandler:
                 level="warn",
             )
 
+    def lock(self, payment_hash: str) -> threading.Lock:
+        return self._locks[hash(payment_hash) % len(self._locks)]
+
+    @contextlib.contextmanager
+    def lock_all(self) -> Iterator[None]:
+        # Always acquired in the same order, so two callers cannot deadlock
+        with contextlib.ExitStack() as stack:
+            for lock in self._locks:
+                stack.enter_context(lock)
+
+            yield
+
     def stop(self) -> None:
+        self._executor.shutdown()
         self._stop_timeout_interval.set()
         self._interval_thread.join()
 
+    def dispatch_htlc(
+        self,
+        htlc_dict: dict[str, str | int],
+        onion: dict[str, Any],
+        request: Request,
+        is_forward: bool,
+    ) -> None:
+        # Forwards and HTLCs of invoices that aren't hold invoices are continued right away;
+        # the lookup is served from memory so only HTLCs of hold invoices go to the workers
+        if is_forward or self._ds.get_invoice(htlc_dict["payment_hash"]) is None:
+            Settler.continue_callback(request)
+            return
+
+        self.submit_htlc(htlc_dict, onion, request)
+
+    def submit_htlc(
+        self,
+        htlc_dict: dict[str, str | int],
+        onion: dict[str, Any],
+        request: Request,
+    ) -> None:
+        self._executor.submit(self._process_htlc, htlc_dict, onion, request)
+
     def handle_htlc(
         self,
         invoice: HoldInvoice,
@@ -58,8 +118,6 @@ class HtlcHandler:
     ) -> None:
         # TODO: test restart handling accept/settle already accepted/settled invoices
 
-        dec = self._plugin.rpc.decodepay(invoice.bolt11)
-
         htlc = Htlc.from_dict(htlc_dict)
 
         if invoice.htlcs.is_known(htlc):
@@ -72,18 +130,18 @@ class HtlcHandler:
 
         invoice.htlcs.add_htlc(htlc)
 
-        if htlc_dict["cltv_expiry_relative"] < dec["min_final_cltv_expiry"]:
+        if htlc_dict["cltv_expiry_relative"] < invoice.min_final_cltv_expiry:
             self._log_htlc_rejected(
                 invoice,
                 htlc,
                 f"CLTV too little ({htlc_dict['cltv_expiry_relative']} < "
-                f"{dec['min_final_cltv_expiry']})",
+                f"{invoice.min_final_cltv_expiry})",
             )
             # TODO: use incorrect_cltv_expiry or expiry_too_soon error?
             self._fail_and_save_htlc(request, invoice, htlc)
             return
 
-        if "payment_secret" not in onion or onion["payment_secret"] != dec["payment_secret"]:
+        if "payment_secret" not in onion or onion["payment_secret"] != invoice.payment_secret:
             self._log_htlc_rejected(
                 invoice,
                 htlc,
@@ -108,6 +166,7 @@ class HtlcHandler:
             return
 
         self._settler.add_htlc(invoice.payment_hash, request, htlc)
+        self._track_expiry(invoice.payment_hash, htlc)
 
         if not invoice.is_fully_paid():
             self._ds.save_invoice(invoice, mode="must-replace")
@@ -123,6 +182,7 @@ class HtlcHandler:
         if htlc.state == HtlcState.Accepted:
             # Pass the request to the settler to handle in the future
             self._settler.add_htlc(invoice.payment_hash, request, htlc)
+            self._track_expiry(invoice.payment_hash, htlc)
 
         elif htlc.state == HtlcState.Paid:
             Settler.settle_callback(request, invoice.payment_preimage)
@@ -130,37 +190,128 @@ class HtlcHandler:
         elif htlc.state == HtlcState.Cancelled:
             Settler.fail_callback(request, HtlcFailureMessage.IncorrectPaymentDetails)
 
+    def _process_htlc(
+        self,
+        htlc_dict: dict[str, str | int],
+        onion: dict[str, Any],
+        request: Request,
+    ) -> None:
+        try:
+            with self.lock(htlc_dict["payment_hash"]):
+                invoice = self._ds.get_invoice(htlc_dict["payment_hash"])
+
+                # The invoice could have been deleted since the HTLC was submitted
+                if invoice is None:
+                    Settler.continue_callback(request)
+                    return
+
+                self.handle_htlc(invoice, htlc_dict, onion, request)
+        except Exception as e:
+            self._plugin.log(f"Handling HTLC failed: {e}", level="error")
+
+            # Continuing would hand the HTLC to the invoice handling of CLN, so it is
+            # failed instead; unless the request was resolved before the error
+            try:
+                Settler.fail_callback(request, HtlcFailureMessage.IncorrectPaymentDetails)
+            except ValueError:
+                return
+
+            self._remove_failed_htlc(htlc_dict)
+
+    def _remove_failed_htlc(self, htlc_dict: dict[str, str | int]) -> None:
+        try:
+            payment_hash = htlc_dict["payment_hash"]
+            htlc = Htlc.from_dict(htlc_dict)
+
+            with self.lock(payment_hash):
+                self._settler.remove_htlc(payment_hash, htlc)
+
+                invoice = self._ds.get_invoice(payment_hash)
+                if invoice is None:
+                    return
+
+                known = invoice.htlcs.find_htlc(htlc.short_channel_id, htlc.channel_id)
+                if known is None or known.state != HtlcState.Accepted:
+                    return
+
+                invoice.htlcs.set_htlc_state(known, HtlcState.Cancelled)
+
+                # An invoice accepted with the failed HTLC is not fully paid anymore; it waits
+                # for more HTLCs again, and the ones it holds can time out again
+                if invoice.state == InvoiceState.Accepted and not invoice.is_fully_paid():
+                    invoice.set_state(self._tracker, InvoiceState.Unpaid)
+
+                    for pending in invoice.htlcs.htlcs:
+                        if pending.state == HtlcState.Accepted:
+                            self._track_expiry(payment_hash, pending)
+
+                self._ds.save_invoice(invoice, mode="must-replace")
+        except Exception as e:
+            self._plugin.log(f"Could not remove failed HTLC: {e}", level="error")
+
     def _start_timeout_interval(self) -> None:
         self._stop_timeout_interval = threading.Event()
 
         def loop() -> None:
-            while not self._stop_timeout_interval.wait(TIMEOUT_CHECK_INTERVAL):
+            while not self._stop_timeout_interval.wait(self._next_expiry_wait()):
                 self._timeout_handler()
 
         self._interval_thread = threading.Thread(target=loop)
         self._interval_thread.start()
 
+    def _track_expiry(self, payment_hash: str, htlc: Htlc) -> None:
+        with self._expiries_lock:
+            heapq.heappush(
+                self._expiries,
+                (htlc.created_at + timedelta(seconds=self._timeout), payment_hash),
+            )
+
+    def _next_expiry_wait(self) -> float:
+        with self._expiries_lock:
+            if len(self._expiries) == 0:
+                return TIMEOUT_CHECK_INTERVAL
+
+            next_expiry = self._expiries[0][0]
+
+        # HTLCs replayed after a restart can expire earlier than the ones already tracked,
+        # so the wait is still capped at the check interval
+        return min(max((next_expiry - time_now()).total_seconds(), 0), TIMEOUT_CHECK_INTERVAL)
+
     def _timeout_handler(self) -> None:
-        with self.lock:
-            for payment_hash in self._settler.pending_payment_hashes():
-                invoice = self._ds.get_invoice(payment_hash)
+        now = time_now()
+        expired_hashes = set()
 
-                if invoice is not None and not invoice.is_fully_paid():
-                    invoice.htlcs.cancel_expired(
-                        self._timeout, self._fail_expired_callback(invoice)
-                    )
-                    self._ds.save_invoice(invoice, mode="must-replace")
+        with self._expiries_lock:
+            while len(self._expiries) > 0 and self._expiries[0][0] <= now:
+                expired_hashes.add(heapq.heappop(self._expiries)[1])
+
+        # Bound to locals to avoid attribute lookups for every payment hash
+        lock, get_invoice, timeout = self.lock, self._ds.get_invoice, self._timeout
+
+        for payment_hash in expired_hashes:
+            with lock(payment_hash):
+                invoice = get_invoice(payment_hash)
 
-    def _fail_expired_callback(
-        self, invoice: HoldInvoice
-    ) -> Callable[[Htlc, HtlcFailureMessage], None]:
-        def callback(htlc: Htlc, message: HtlcFailureMessage) -> None:
-            request = self._settler.find_htlc_request(invoice.payment_hash, htlc)
-            if request is not None:
-                Settler.fail_callback(request, message)
-                self._settler.remove_htlc(invoice.payment_hash, htlc)
+                # Invoices that were paid or resolved in the meantime are skipped
+                if (
+                    invoice is None
+                    or invoice.state != InvoiceState.Unpaid
+                    or invoice.is_fully_paid()
+                ):
+                    continue
+
+                expired_htlcs = invoice.htlcs.cancel_expired(timeout)
+                for htlc in expired_htlcs:
+                    self._fail_expired_htlc(payment_hash, htlc)
+
+                if len(expired_htlcs) > 0:
+                    self._ds.save_invoice(invoice, mode="must-replace")
 
-        return callback
+    def _fail_expired_htlc(self, payment_hash: str, htlc: Htlc) -> None:
+        request = self._settler.find_htlc_request(payment_hash, htlc)
+        if request is not None:
+            Settler.fail_callback(request, HtlcFailureMessage.MppTimeout)
+            self._settler.remove_htlc(payment_hash, htlc)
 
     def _fail_and_save_htlc(
         self,
@@ -171,7 +322,7 @@ class HtlcHandler:
     ) -> None:
         Settler.fail_callback(request, message)
 
-        htlc.state = HtlcState.Cancelled
+        invoice.htlcs.set_htlc_state(htlc, HtlcState.Cancelled)
         self._ds.save_invoice(invoice, mode="must-replace")
 
     def _log_htlc_rejected(self, invoice: HoldInvoice, htlc: Htlc, msg: str) -> None:
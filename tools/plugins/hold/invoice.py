@@ -1,25 +1,21 @@
-import json
 from dataclasses import dataclass
-from datetime import date, datetime, timezone
-from enum import Enum
-from json import JSONEncoder
-from typing import Any, Callable, TypeVar
+from datetime import datetime, timedelta, timezone
+from typing import Any, TypeVar
 
 import bolt11
 
 from plugins.hold.enums import (
     POSSIBLE_STATE_TRANSITIONS,
-    HtlcFailureMessage,
     HtlcState,
     InvoiceState,
 )
 from plugins.hold.tracker import Tracker
-from plugins.hold.utils import time_now
+from plugins.hold.utils import json_dumps, json_loads, time_now
 
 HtlcType = TypeVar("HtlcType", bound="Htlc")
 
 
-@dataclass
+@dataclass(slots=True)
 class Htlc:
     state: HtlcState
     short_channel_id: str
@@ -33,8 +29,11 @@ class Htlc:
 
     def to_dict(self) -> dict[str, Any]:
         return {
-            k: int(v.timestamp()) if isinstance(v, datetime) else v
-            for k, v in self.__dict__.items()
+            "state": self.state.value,
+            "short_channel_id": self.short_channel_id,
+            "channel_id": self.channel_id,
+            "msat": self.msat,
+            "created_at": int(self.created_at.timestamp()),
         }
 
     @classmethod
@@ -49,6 +48,7 @@ class Htlc:
 
     @classmethod
     def from_json_dict(cls: type[HtlcType], json_dict: dict[str, Any]) -> HtlcType:
+        json_dict["state"] = HtlcState(json_dict["state"])
         json_dict["created_at"] = datetime.fromtimestamp(json_dict["created_at"], tz=timezone.utc)
 
         return cls(**json_dict)
@@ -56,12 +56,21 @@ class Htlc:
 
 HtlcsType = TypeVar("HtlcsType", bound="Htlcs")
 
+_PAID_HTLC_STATES = [HtlcState.Paid, HtlcState.Accepted]
+
 
 class Htlcs:
+    __slots__ = ("htlcs", "_paid_msat")
+
     htlcs: list[Htlc]
 
+    # Running total of the accepted and paid HTLCs;
+    # state changes have to go through set_htlc_state to keep it accurate
+    _paid_msat: int
+
     def __init__(self) -> None:
         self.htlcs = []
+        self._paid_msat = 0
 
     def __len__(self) -> int:
         """Return the number of accepted HTLCs."""
@@ -70,6 +79,23 @@ class Htlcs:
     def add_htlc(self, htlc: Htlc) -> None:
         self.htlcs.append(htlc)
 
+        if htlc.state in _PAID_HTLC_STATES:
+            self._paid_msat += htlc.msat
+
+    def set_htlc_state(self, htlc: Htlc, new_state: HtlcState) -> None:
+        was_paid = htlc.state in _PAID_HTLC_STATES
+        is_paid = new_state in _PAID_HTLC_STATES
+
+        if was_paid and not is_paid:
+            self._paid_msat -= htlc.msat
+        elif is_paid and not was_paid:
+            self._paid_msat += htlc.msat
+
+        htlc.state = new_state
+
+    def sum_paid(self) -> int:
+        return self._paid_msat
+
     def is_known(self, htlc: Htlc) -> bool:
         return self.find_htlc(htlc.short_channel_id, htlc.channel_id) is not None
 
@@ -83,22 +109,28 @@ class Htlcs:
             None,
         )
 
-    def cancel_expired(
-        self,
-        expiry: int,
-        fail_callback: Callable[[Htlc, HtlcFailureMessage], None],
-    ) -> None:
+    def cancel_expired(self, expiry: int) -> list[Htlc]:
+        cutoff = time_now() - timedelta(seconds=expiry)
+
+        # Bound to locals to avoid global lookups for every HTLC
+        accepted, cancelled = HtlcState.Accepted, HtlcState.Cancelled
+        set_state = self.set_htlc_state
+
+        expired = []
         for htlc in self.htlcs:
-            if not (time_now() - htlc.created_at).total_seconds() > expiry:
+            if htlc.state != accepted or htlc.created_at > cutoff:
                 continue
 
-            htlc.state = HtlcState.Cancelled
-            fail_callback(htlc, HtlcFailureMessage.MppTimeout)
+            set_state(htlc, cancelled)
+            expired.append(htlc)
+
+        return expired
 
     @classmethod
     def from_json_arr(cls: type[HtlcsType], json_arr: list[Any]) -> HtlcsType:
         htlcs = cls()
-        htlcs.htlcs = [Htlc.from_json_dict(entry) for entry in json_arr]
+        for entry in json_arr:
+            htlcs.add_htlc(Htlc.from_json_dict(entry))
 
         return htlcs
 
@@ -114,28 +146,18 @@ class HoldInvoiceStateError(ValueError):
         }
 
 
-class HoldInvoiceEncoder(JSONEncoder):
-    def default(self, obj: object) -> str | int | list | None:
-        if isinstance(obj, (date, datetime)):
-            return int(obj.timestamp())
-
-        if isinstance(obj, Enum):
-            return obj.value
-
-        if isinstance(obj, Htlcs):
-            return [htlc.to_dict() for htlc in obj.htlcs]
-
-        return None
-
-
 HoldInvoiceType = TypeVar("HoldInvoiceType", bound="HoldInvoice")
 
+_DECODED_FIELDS = ["amount_msat", "min_final_cltv_expiry", "payment_secret"]
+
 
-@dataclass
+@dataclass(slots=True)
 class HoldInvoice:
     state: InvoiceState
     bolt11: str
     amount_msat: int
+    min_final_cltv_expiry: int
+    payment_secret: str
     payment_hash: str
     payment_preimage: str | None
     created_at: datetime
@@ -145,35 +167,35 @@ class HoldInvoice:
         if self.state == new_state:
             return
 
-        if new_state not in POSSIBLE_STATE_TRANSITIONS[self.state]:
-            raise HoldInvoiceStateError(self.state, new_state)
+        self.check_state_transition(new_state)
 
         self.state = new_state
         tracker.send_update(self.payment_hash, self.bolt11, self.state)
 
+    def check_state_transition(self, new_state: InvoiceState) -> None:
+        if self.state != new_state and new_state not in POSSIBLE_STATE_TRANSITIONS[self.state]:
+            raise HoldInvoiceStateError(self.state, new_state)
+
     def is_fully_paid(self) -> bool:
         return self.amount_msat <= self.sum_paid()
 
     def sum_paid(self) -> int:
-        return sum(
-            h.msat for h in self.htlcs.htlcs if h.state in [HtlcState.Paid, HtlcState.Accepted]
-        )
+        return self.htlcs.sum_paid()
 
     def to_json(self) -> str:
-        return json.dumps(
-            self.__dict__,
-            cls=HoldInvoiceEncoder,
-        )
+        return json_dumps(self.to_dict())
 
     def to_dict(self) -> dict[str, Any]:
-        self_with_htlcs = {
-            k: v if not isinstance(v, Htlcs) else [htlc.to_dict() for htlc in v.htlcs]
-            for k, v in self.__dict__.items()
-        }
-
         return {
-            k: int(v.timestamp()) if isinstance(v, datetime) else v
-            for k, v in self_with_htlcs.items()
+            "state": self.state.value,
+            "bolt11": self.bolt11,
+            "amount_msat": self.amount_msat,
+            "min_final_cltv_expiry": self.min_final_cltv_expiry,
+            "payment_secret": self.payment_secret,
+            "payment_hash": self.payment_hash,
+            "payment_preimage": self.payment_preimage,
+            "created_at": int(self.created_at.timestamp()),
+            "htlcs": [htlc.to_dict() for htlc in self.htlcs.htlcs],
         }
 
     @classmethod
@@ -183,12 +205,17 @@ class HoldInvoice:
         if json_str.endswith("\\}"):
             json_str = json_str.removesuffix("\\}") + "}"
 
-        json_dict = json.loads(json_str)
+        json_dict = json_loads(json_str)
+        json_dict["state"] = InvoiceState(json_dict["state"])
         json_dict["created_at"] = datetime.fromtimestamp(json_dict["created_at"], tz=timezone.utc)
 
-        if "amount_msat" not in json_dict:
-            json_dict["amount_msat"] = bolt11.decode(json_dict["bolt11"]).amount_msat
+        # Invoices saved by older versions of the plugin lack the decoded fields
+        if any(key not in json_dict for key in _DECODED_FIELDS):
+            dec = bolt11.decode(json_dict["bolt11"])
+            json_dict.setdefault("amount_msat", int(dec.amount_msat))
+            json_dict.setdefault("min_final_cltv_expiry", dec.min_final_cltv_expiry)
+            json_dict.setdefault("payment_secret", dec.payment_secret)
 
-        json_dict["htlcs"] = Htlcs.from_json_arr(json_dict["htlcs"]) if "htlcs" in json_dict else []
+        json_dict["htlcs"] = Htlcs.from_json_arr(json_dict.get("htlcs", []))
 
         return cls(**json_dict)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import contextlib
 import sys
+from functools import lru_cache
 from typing import Any
 
 import bolt11
@@ -18,13 +19,13 @@ from plugins.hold.errors import Errors
 from plugins.hold.hold import (
     Hold,
     InvalidPaymentHashLengthError,
+    InvalidPaymentPreimageLengthError,
     InvoiceExistsError,
     NoSuchInvoiceError,
 )
 from plugins.hold.invoice import HoldInvoiceStateError
 from plugins.hold.router import NoRouteError
 from plugins.hold.server import Server
-from plugins.hold.settler import Settler
 from plugins.hold.transformers import Transformers
 
 empty_value = ["", "none", "null", None]
@@ -35,6 +36,15 @@ server = Server(pl, hold)
 
 register_options(pl)
 
+# Bound once since the htlc_accepted hook calls it for every HTLC
+dispatch_htlc = hold.handler.dispatch_htlc
+
+
+# Decoding checks the signature of the invoice, which is costly; invoices are immutable
+@lru_cache(maxsize=1024)
+def decode_payment_hash(invoice: str) -> str:
+    return bolt11.decode(invoice).payment_hash
+
 
 @pl.init()
 def init(
@@ -94,7 +104,7 @@ def hold_invoice(
 def list_hold_invoices(plugin: Plugin, payment_hash: str = "", invoice: str = "") -> dict[str, Any]:
     """List one or more hold invoices."""
     if payment_hash in empty_value and invoice not in empty_value:
-        payment_hash = bolt11.decode(invoice).payment_hash
+        payment_hash = decode_payment_hash(invoice)
     elif (
         payment_hash is not None
         and len(payment_hash) > 64
@@ -102,10 +112,10 @@ def list_hold_invoices(plugin: Plugin, payment_hash: str = "", invoice: str = ""
     ):
         # To allow the first parameter to be the invoice
         with contextlib.suppress(Bolt11Bech32InvalidException):
-            payment_hash = bolt11.decode(payment_hash).payment_hash
+            payment_hash = decode_payment_hash(payment_hash)
 
     return {
-        "holdinvoices": [invoice.to_dict() for invoice in hold.list_invoices(payment_hash)],
+        "holdinvoices": hold.list_invoice_dicts(payment_hash),
     }
 
 
@@ -117,6 +127,8 @@ def settle_hold_invoice(plugin: Plugin, payment_preimage: str) -> dict[str, Any]
     """Settle a hold invoice."""
     try:
         hold.settle(payment_preimage)
+    except InvalidPaymentPreimageLengthError:
+        return Errors.invalid_payment_preimage_length
     except NoSuchInvoiceError:
         return Errors.invoice_not_exists
     except HoldInvoiceStateError as e:
@@ -206,20 +218,7 @@ def on_htlc_accepted(
     plugin: Plugin,
     **kwargs: dict[str, Any],
 ) -> None:
-    # Ignore forwards
-    if "forward_to" in kwargs:
-        Settler.continue_callback(request)
-        return
-
-    with hold.handler.lock:
-        invoice = hold.ds.get_invoice(htlc["payment_hash"])
-
-        # Ignore invoices that aren't hold invoices
-        if invoice is None:
-            Settler.continue_callback(request)
-            return
-
-        hold.handler.handle_htlc(invoice, htlc, onion, request)
+    dispatch_htlc(htlc, onion, request, "forward_to" in kwargs)
 
 
 @pl.subscribe("shutdown")
@@ -229,7 +228,7 @@ def shutdown(**kwargs: dict[str, Any]) -> None:
     if server.is_running():
         server.stop()
 
-    hold.handler.stop()
+    hold.stop()
 
     pl.log(f"Plugin {PLUGIN_NAME} stopped")
     sys.exit(0)
@@ -0,0 +1,24 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from pyln.client import Plugin
+
+
+class RpcPool:
+    # pyln connects a new socket to lightningd for every call,
+    # so calls made from different threads do not wait for each other
+    _plugin: Plugin
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, plugin: Plugin, max_workers: int = 16) -> None:
+        self._plugin = plugin
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="rpc",
+        )
+
+    def submit(self, method: str, payload: dict[str, Any] | None = None) -> Future[Any]:
+        return self._executor.submit(self._plugin.rpc.call, method, payload)
+
+    def stop(self) -> None:
+        self._executor.shutdown()
@@ -89,7 +89,7 @@ class HoldService(HoldServicer):
         return ListResponse(
             invoices=[
                 Transformers.invoice_to_grpc(inv)
-                for inv in self._hold.list_invoices(request.payment_hash)
+                for inv in self._hold.list_invoice_dicts(request.payment_hash)
             ]
         )
 
@@ -114,13 +114,13 @@ class HoldService(HoldServicer):
     ) -> Iterable[TrackResponse]:
         try:
             queue = self._hold.tracker.track(request.payment_hash)
-            invoices = self._hold.list_invoices(request.payment_hash)
+            invoices = self._hold.list_invoice_dicts(request.payment_hash)
 
             if len(invoices) == 0:
                 self._hold.tracker.stop_tracking(request.payment_hash, queue)
                 raise NoSuchInvoiceError  # noqa: TRY301
 
-            yield TrackResponse(state=INVOICE_STATE_TO_GRPC[invoices[0].state])
+            yield TrackResponse(state=INVOICE_STATE_TO_GRPC[invoices[0]["state"]])
 
             while context.is_active():
                 state = queue.get()
@@ -6,6 +6,13 @@ from plugins.hold.enums import HtlcFailureMessage, HtlcState
 from plugins.hold.invoice import HoldInvoice, Htlc, InvoiceState
 from plugins.hold.tracker import Tracker
 
+# pyln does not mutate the results it sends, so the ones without
+# variable fields are built once and shared by all requests
+_CONTINUE_RESULT = {"result": "continue"}
+_FAIL_RESULTS = {
+    message: {"result": "fail", "failure_message": message.value} for message in HtlcFailureMessage
+}
+
 
 @dataclass
 class HtlcRequest:
@@ -48,9 +55,6 @@ class Settler:
 
         invoice.set_state(self._tracker, InvoiceState.Cancelled)
 
-    def pending_payment_hashes(self) -> list[str]:
-        return list(self._htlcs.keys())
-
     def find_htlc_request(self, payment_hash: str, htlc: Htlc) -> Request | None:
         if payment_hash not in self._htlcs:
             return None
@@ -81,24 +85,18 @@ class Settler:
 
     @staticmethod
     def _update_htlc_state(invoice: HoldInvoice, htlc: HtlcRequest, new_state: HtlcState) -> None:
-        invoice.htlcs.find_htlc(htlc.short_channel_id, htlc.channel_id).state = new_state
+        invoice.htlcs.set_htlc_state(
+            invoice.htlcs.find_htlc(htlc.short_channel_id, htlc.channel_id),
+            new_state,
+        )
 
     @staticmethod
     def fail_callback(req: Request, message: HtlcFailureMessage) -> None:
-        req.set_result(
-            {
-                "result": "fail",
-                "failure_message": message,
-            }
-        )
+        req.set_result(_FAIL_RESULTS[message])
 
     @staticmethod
     def continue_callback(req: Request) -> None:
-        req.set_result(
-            {
-                "result": "continue",
-            }
-        )
+        req.set_result(_CONTINUE_RESULT)
 
     @staticmethod
     def settle_callback(req: Request, preimage: str) -> None:
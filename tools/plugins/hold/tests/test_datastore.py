@@ -0,0 +1,355 @@
+from collections.abc import Iterator
+from typing import Any
+
+import pytest
+from pyln.client import RpcError
+
+from plugins.hold import datastore
+from plugins.hold.consts import PLUGIN_NAME
+from plugins.hold.datastore import DataStore
+from plugins.hold.enums import InvoiceState
+from plugins.hold.invoice import HoldInvoice, HoldInvoiceStateError
+from plugins.hold.rpc_pool import RpcPool
+from plugins.hold.settler import Settler
+from plugins.hold.tests.utils import (
+    FakePlugin,
+    FakeRequest,
+    create_hold_invoice,
+    create_htlc,
+    datastore_error,
+)
+from plugins.hold.tracker import Tracker
+
+
+def create_accepted_invoice(ds: DataStore, payment_hash: str) -> tuple[HoldInvoice, FakeRequest]:
+    invoice = create_hold_invoice(payment_hash)
+    ds.save_invoice(invoice)
+
+    htlc = create_htlc(msat=invoice.amount_msat)
+    invoice.htlcs.add_htlc(htlc)
+    invoice.state = InvoiceState.Accepted
+    ds.save_invoice(invoice, mode="must-replace")
+    ds.flush()
+
+    request = FakeRequest()
+    ds._settler.add_htlc(payment_hash, request, htlc)  # noqa: SLF001
+
+    return invoice, request
+
+
+def fail_updates(
+    plugin: FakePlugin,
+    monkeypatch: pytest.MonkeyPatch,
+    count: int,
+) -> list[str]:
+    """Make the next count updates of existing keys fail and record their payment hashes."""
+    write = plugin.rpc.datastore
+    failed = []
+
+    def failing_write(key: list[str], string: str, mode: str) -> dict[str, Any]:
+        if mode == "must-replace" and len(failed) < count:
+            failed.append(key[-1])
+            raise datastore_error(-32602)
+
+        return write(key, string, mode)
+
+    monkeypatch.setattr(plugin.rpc, "datastore", failing_write)
+    return failed
+
+
+def datastore_key(payment_hash: str) -> tuple[str, ...]:
+    return PLUGIN_NAME, "invoices", payment_hash
+
+
+@pytest.fixture()
+def plugin() -> FakePlugin:
+    return FakePlugin()
+
+
+@pytest.fixture()
+def ds(plugin: FakePlugin, monkeypatch: pytest.MonkeyPatch) -> Iterator[DataStore]:
+    # Pending updates are only written when the tests flush them
+    monkeypatch.setattr(DataStore, "_flush_interval", 3600)
+
+    rpc_pool = RpcPool(plugin)
+    ds = DataStore(plugin, Settler(Tracker()), rpc_pool)
+    ds.init()
+
+    yield ds
+
+    ds.stop()
+    rpc_pool.stop()
+
+
+class TestDataStore:
+    def test_updates_coalesced(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoice = create_hold_invoice("11" * 32)
+        ds.save_invoice(invoice)
+
+        for state in [InvoiceState.Accepted, InvoiceState.Cancelled]:
+            invoice.state = state
+            ds.save_invoice(invoice, mode="must-replace")
+
+        assert [write["state"] for write in plugin.rpc.writes] == ["unpaid"]
+
+        ds.flush()
+
+        assert [write["state"] for write in plugin.rpc.writes] == ["unpaid", "cancelled"]
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Cancelled
+
+    def test_settle_written_before_return(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoice, request = create_accepted_invoice(ds, "11" * 32)
+
+        ds.settle_invoice(invoice, "22" * 32)
+
+        assert request.result == {"result": "resolve", "payment_key": "22" * 32}
+        stored = plugin.rpc.stored_invoice(invoice.payment_hash)
+        assert stored.state == InvoiceState.Paid
+        assert stored.payment_preimage == "22" * 32
+
+    def test_settle_illegal_transition(self, ds: DataStore) -> None:
+        invoice = create_hold_invoice("11" * 32)
+        ds.save_invoice(invoice)
+
+        with pytest.raises(HoldInvoiceStateError):
+            ds.settle_invoice(invoice, "22" * 32)
+
+        assert invoice.state == InvoiceState.Unpaid
+        assert invoice.payment_preimage is None
+
+    def test_settle_raises_until_written(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice, _ = create_accepted_invoice(ds, "11" * 32)
+        fail_updates(plugin, monkeypatch, 2)
+
+        with pytest.raises(RpcError):
+            ds.settle_invoice(invoice, "22" * 32)
+
+        # The invoice is paid in memory already; settling again retries the write
+        with pytest.raises(RpcError):
+            ds.settle_invoice(invoice, "22" * 32)
+
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Accepted
+
+        ds.settle_invoice(invoice, "22" * 32)
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Paid
+
+    def test_cancel_raises_until_written(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice, request = create_accepted_invoice(ds, "11" * 32)
+        fail_updates(plugin, monkeypatch, 1)
+
+        with pytest.raises(RpcError):
+            ds.cancel_invoice(invoice)
+
+        assert request.result is not None
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Accepted
+
+        ds.cancel_invoice(invoice)
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Cancelled
+
+    def test_failed_flush_retried(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice = create_hold_invoice("11" * 32)
+        ds.save_invoice(invoice)
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+        fail_updates(plugin, monkeypatch, 1)
+
+        with pytest.raises(RpcError):
+            ds.flush()
+
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Unpaid
+
+        ds.flush()
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Cancelled
+
+    def test_failed_flush_backoff(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice = create_hold_invoice()
+        ds.save_invoice(invoice)
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+        failed = fail_updates(plugin, monkeypatch, DataStore._max_write_attempts + 1)  # noqa: SLF001
+
+        now = [0.0]
+        monkeypatch.setattr(datastore, "monotonic", lambda: now[0])
+
+        # Retried once the delay, which doubles with every attempt, has passed
+        for attempt in range(1, DataStore._max_write_attempts + 1):  # noqa: SLF001
+            ds._flush(None, due_only=True)  # noqa: SLF001
+            assert len(failed) == attempt
+
+            ds._flush(None, due_only=True)  # noqa: SLF001
+            assert len(failed) == attempt
+
+            now[0] += DataStore._retry_delay * 2 ** (attempt - 1)  # noqa: SLF001
+
+        # No more retries in the background once the attempts run out
+        now[0] += 3600
+        ds._flush(None, due_only=True)  # noqa: SLF001
+        assert len(failed) == DataStore._max_write_attempts  # noqa: SLF001
+        assert [level for level, _ in plugin.logs] == ["warn", "error"]
+
+        # Explicit flushes still retry the update
+        with pytest.raises(RpcError):
+            ds.flush()
+
+        ds.flush()
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Cancelled
+        assert ds._write_failures == {}  # noqa: SLF001
+        assert [level for level, _ in plugin.logs] == ["warn", "error"]
+
+    def test_update_of_missing_key_dropped(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoice = create_hold_invoice()
+        ds.save_invoice(invoice)
+        plugin.rpc.deldatastore(list(datastore_key(invoice.payment_hash)))
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+
+        with pytest.raises(RpcError):
+            ds.flush()
+
+        assert ds._dirty == {}  # noqa: SLF001
+        assert ds._write_failures == {}  # noqa: SLF001
+        assert len(plugin.logs) == 1
+
+        ds.flush()
+        assert plugin.rpc.store == {}
+
+    def test_stop_failed_flush(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice = create_hold_invoice()
+        ds.save_invoice(invoice)
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+        fail_updates(plugin, monkeypatch, 1)
+
+        ds.stop()
+
+        assert plugin.logs[-1][0] == "error"
+        assert plugin.rpc.stored_invoice(invoice.payment_hash).state == InvoiceState.Unpaid
+
+    def test_failed_flush_keeps_newer_update(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        invoice = create_hold_invoice("11" * 32)
+        ds.save_invoice(invoice)
+
+        invoice.state = InvoiceState.Accepted
+        ds.save_invoice(invoice, mode="must-replace")
+
+        # The invoice is updated again while the failing write is in flight
+        def failing_write(key: list[str], string: str, mode: str) -> dict[str, Any]:
+            invoice.state = InvoiceState.Cancelled
+            ds.save_invoice(invoice, mode="must-replace")
+            raise datastore_error(-32602)
+
+        write = plugin.rpc.datastore
+        monkeypatch.setattr(plugin.rpc, "datastore", failing_write)
+
+        with pytest.raises(RpcError):
+            ds.flush()
+
+        monkeypatch.setattr(plugin.rpc, "datastore", write)
+        ds.flush()
+
+        assert [write["state"] for write in plugin.rpc.writes] == ["unpaid", "cancelled"]
+
+    def test_delete_invoice_pending_update(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoice = create_hold_invoice("11" * 32)
+        ds.save_invoice(invoice)
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+
+        assert ds.delete_invoice(invoice.payment_hash)
+        ds.flush()
+
+        assert plugin.rpc.store == {}
+        assert ds.get_invoice(invoice.payment_hash) is None
+        assert ds.list_invoice_dicts(None) == []
+
+    def test_update_after_delete_dropped(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoice = create_hold_invoice()
+        ds.save_invoice(invoice)
+        assert ds.delete_invoice(invoice.payment_hash)
+
+        invoice.state = InvoiceState.Cancelled
+        ds.save_invoice(invoice, mode="must-replace")
+        ds.flush()
+
+        assert plugin.rpc.store == {}
+        assert ds.get_invoice(invoice.payment_hash) is None
+        assert ds.list_invoice_dicts(None) == []
+
+    def test_delete_invoices_pending_update(self, ds: DataStore, plugin: FakePlugin) -> None:
+        invoices = [create_hold_invoice("11" * 32), create_hold_invoice("22" * 32)]
+        for invoice in invoices:
+            ds.save_invoice(invoice)
+
+            invoice.state = InvoiceState.Cancelled
+            ds.save_invoice(invoice, mode="must-replace")
+
+        assert ds.delete_invoices() == 2
+        ds.flush()
+
+        assert plugin.rpc.store == {}
+        assert ds.list_invoice_dicts(None) == []
+
+    def test_delete_invoices_partial_failure(
+        self,
+        ds: DataStore,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        payment_hashes = ["11" * 32, "22" * 32, "33" * 32]
+        for payment_hash in payment_hashes:
+            ds.save_invoice(create_hold_invoice(payment_hash))
+
+        delete = plugin.rpc.deldatastore
+
+        def failing_delete(key: list[str]) -> dict[str, Any]:
+            if key[-1] == payment_hashes[1]:
+                raise datastore_error(1201)
+
+            return delete(key)
+
+        monkeypatch.setattr(plugin.rpc, "deldatastore", failing_delete)
+
+        with pytest.raises(RpcError):
+            ds.delete_invoices()
+
+        assert list(plugin.rpc.store) == [datastore_key(payment_hashes[1])]
+        assert [invoice["payment_hash"] for invoice in ds.list_invoice_dicts(None)] == [
+            payment_hashes[1]
+        ]
+        assert ds.get_invoice(payment_hashes[0]) is None
+        assert ds.get_invoice(payment_hashes[2]) is None
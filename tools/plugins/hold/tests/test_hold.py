@@ -0,0 +1,104 @@
+import hashlib
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+import pytest
+
+from plugins.hold.datastore import DataStore
+from plugins.hold.enums import InvoiceState
+from plugins.hold.hold import Hold
+from plugins.hold.invoice import HoldInvoiceStateError
+from plugins.hold.tests.utils import FakePlugin, FakeRequest, create_hold_invoice
+
+# Long enough for a thread that is not blocked to finish its work
+BLOCKED_WAIT = 0.1
+
+
+@pytest.fixture()
+def hold(monkeypatch: pytest.MonkeyPatch) -> Iterator[Hold]:
+    # Pending updates are only written when the tests flush them
+    monkeypatch.setattr(DataStore, "_flush_interval", 3600)
+
+    hold = Hold(FakePlugin())
+    hold.ds.init()
+
+    yield hold
+
+    hold.stop()
+
+
+def run_thread(target: Callable[..., Any], *args: Any) -> tuple[threading.Thread, list[Any]]:  # noqa: ANN401
+    errors = []
+
+    def run() -> None:
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    return thread, errors
+
+
+class TestHold:
+    def test_settle_serialized_with_htlc(self, hold: Hold) -> None:
+        preimage = "22" * 32
+        invoice = create_hold_invoice(hashlib.sha256(bytes.fromhex(preimage)).hexdigest())
+        hold.ds.save_invoice(invoice)
+
+        request = FakeRequest()
+        htlc_dict = {
+            "payment_hash": invoice.payment_hash,
+            "short_channel_id": "811x1x0",
+            "id": 0,
+            "amount_msat": invoice.amount_msat,
+            "cltv_expiry_relative": invoice.min_final_cltv_expiry,
+        }
+
+        with hold.handler.lock(invoice.payment_hash):
+            htlc_thread, htlc_errors = run_thread(
+                hold.handler._process_htlc,  # noqa: SLF001
+                htlc_dict,
+                {"payment_secret": invoice.payment_secret},
+                request,
+            )
+            settle_thread, settle_errors = run_thread(hold.settle, preimage)
+
+            time.sleep(BLOCKED_WAIT)
+            assert htlc_thread.is_alive()
+            assert settle_thread.is_alive()
+            assert invoice.state == InvoiceState.Unpaid
+            assert len(invoice.htlcs.htlcs) == 0
+
+        htlc_thread.join()
+        settle_thread.join()
+        assert htlc_errors == []
+
+        # Either order is fine, but each one has to see the complete result of the other
+        if len(settle_errors) == 0:
+            assert invoice.state == InvoiceState.Paid
+            assert request.result == {"result": "resolve", "payment_key": preimage}
+        else:
+            assert isinstance(settle_errors[0], HoldInvoiceStateError)
+            assert invoice.state == InvoiceState.Accepted
+            assert request.result is None
+
+    @pytest.mark.parametrize("payment_hash", ["11" * 32, ""])
+    def test_wipe_waits_for_invoice_lock(self, hold: Hold, payment_hash: str) -> None:
+        invoice = create_hold_invoice()
+        hold.ds.save_invoice(invoice)
+
+        with hold.handler.lock(invoice.payment_hash):
+            wipe = threading.Thread(target=hold.wipe, args=(payment_hash,))
+            wipe.start()
+
+            time.sleep(BLOCKED_WAIT)
+            assert wipe.is_alive()
+            assert hold.ds.get_invoice(invoice.payment_hash) is invoice
+
+        wipe.join()
+        assert hold.ds.get_invoice(invoice.payment_hash) is None
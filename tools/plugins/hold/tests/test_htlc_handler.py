@@ -0,0 +1,373 @@
+import random
+from collections.abc import Iterator
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from plugins.hold import htlc_handler, invoice
+from plugins.hold.consts import TIMEOUT_CANCEL, TIMEOUT_CHECK_INTERVAL
+from plugins.hold.datastore import DataStore
+from plugins.hold.enums import HtlcFailureMessage, HtlcState, InvoiceState
+from plugins.hold.htlc_handler import HtlcHandler
+from plugins.hold.invoice import HoldInvoice, Htlc
+from plugins.hold.rpc_pool import RpcPool
+from plugins.hold.settler import _CONTINUE_RESULT, Settler
+from plugins.hold.tests.utils import (
+    FakePlugin,
+    FakeRequest,
+    create_hold_invoice,
+    create_htlc,
+)
+from plugins.hold.tracker import Tracker
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FrozenClock:
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.now = NOW
+
+        for module in (htlc_handler, invoice):
+            monkeypatch.setattr(module, "time_now", lambda: self.now)
+
+
+@pytest.fixture()
+def clock(monkeypatch: pytest.MonkeyPatch) -> FrozenClock:
+    return FrozenClock(monkeypatch)
+
+
+@pytest.fixture()
+def plugin() -> FakePlugin:
+    return FakePlugin()
+
+
+@pytest.fixture()
+def handler(plugin: FakePlugin, monkeypatch: pytest.MonkeyPatch) -> Iterator[HtlcHandler]:
+    # Pending updates are only written when the tests flush them
+    monkeypatch.setattr(DataStore, "_flush_interval", 3600)
+
+    tracker = Tracker()
+    settler = Settler(tracker)
+    rpc_pool = RpcPool(plugin)
+    ds = DataStore(plugin, settler, rpc_pool)
+    handler = HtlcHandler(plugin, ds, settler, tracker)
+
+    # The tests drive the expiry scheduler themselves
+    handler.stop()
+
+    yield handler
+
+    ds.stop()
+    rpc_pool.stop()
+
+
+def add_pending_htlc(
+    handler: HtlcHandler,
+    state: InvoiceState = InvoiceState.Unpaid,
+) -> tuple[HoldInvoice, Htlc, FakeRequest]:
+    htlc = create_htlc(created_at=NOW)
+    hold_invoice = create_hold_invoice(
+        amount_msat=2_000,
+        state=state,
+        htlcs=[htlc],
+        created_at=NOW,
+    )
+    handler._ds.save_invoice(hold_invoice)  # noqa: SLF001
+
+    request = FakeRequest()
+    handler._settler.add_htlc(hold_invoice.payment_hash, request, htlc)  # noqa: SLF001
+    handler._track_expiry(hold_invoice.payment_hash, htlc)  # noqa: SLF001
+
+    return hold_invoice, htlc, request
+
+
+def htlc_dict(payment_hash: str, channel_id: int, msat: int = 1_000) -> dict[str, str | int]:
+    return {
+        "payment_hash": payment_hash,
+        "short_channel_id": "811x1x0",
+        "id": channel_id,
+        "amount_msat": msat,
+        "cltv_expiry_relative": 80,
+    }
+
+
+def fail_next_save(handler: HtlcHandler, monkeypatch: pytest.MonkeyPatch) -> None:
+    ds = handler._ds  # noqa: SLF001
+    save_invoice = ds.save_invoice
+    failed = []
+
+    def failing_save(hold_invoice: HoldInvoice, mode: str = "must-create") -> None:
+        if len(failed) == 0:
+            failed.append(hold_invoice.payment_hash)
+            msg = "could not save"
+            raise RuntimeError(msg)
+
+        save_invoice(hold_invoice, mode)
+
+    monkeypatch.setattr(ds, "save_invoice", failing_save)
+
+
+def record_submitted(handler: HtlcHandler, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    submitted = []
+    monkeypatch.setattr(
+        handler,
+        "submit_htlc",
+        lambda htlc, onion, request: submitted.append(htlc["payment_hash"]),  # noqa: ARG005
+    )
+
+    return submitted
+
+
+class TestDispatch:
+    def test_forward_continued(
+        self,
+        handler: HtlcHandler,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        hold_invoice = create_hold_invoice()
+        handler._ds.save_invoice(hold_invoice)  # noqa: SLF001
+        submitted = record_submitted(handler, monkeypatch)
+
+        # Even when the payment hash belongs to a hold invoice
+        request = FakeRequest()
+        handler.dispatch_htlc(htlc_dict(hold_invoice.payment_hash, 0), {}, request, True)
+
+        assert request.result is _CONTINUE_RESULT
+        assert submitted == []
+
+    def test_unknown_payment_hash_continued(
+        self,
+        handler: HtlcHandler,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        submitted = record_submitted(handler, monkeypatch)
+
+        request = FakeRequest()
+        handler.dispatch_htlc(htlc_dict("22" * 32, 0), {}, request, False)
+
+        assert request.result is _CONTINUE_RESULT
+        assert submitted == []
+
+    def test_hold_invoice_submitted(
+        self,
+        handler: HtlcHandler,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        hold_invoice = create_hold_invoice()
+        handler._ds.save_invoice(hold_invoice)  # noqa: SLF001
+        submitted = record_submitted(handler, monkeypatch)
+
+        request = FakeRequest()
+        handler.dispatch_htlc(htlc_dict(hold_invoice.payment_hash, 0), {}, request, False)
+
+        assert request.result is None
+        assert submitted == [hold_invoice.payment_hash]
+
+
+class TestHookResults:
+    def test_continue_result_shared(self) -> None:
+        requests = [FakeRequest(), FakeRequest()]
+        for request in requests:
+            Settler.continue_callback(request)
+
+        assert all(request.result is _CONTINUE_RESULT for request in requests)
+        assert {"result": "continue"} == _CONTINUE_RESULT
+
+    @pytest.mark.parametrize("message", list(HtlcFailureMessage))
+    def test_fail_results_shared(self, message: HtlcFailureMessage) -> None:
+        requests = [FakeRequest(), FakeRequest()]
+        for request in requests:
+            Settler.fail_callback(request, message)
+
+        assert requests[0].result is requests[1].result
+        assert requests[0].result == {"result": "fail", "failure_message": message.value}
+
+
+class TestExpiryScheduler:
+    def test_expires_at_timeout(
+        self,
+        handler: HtlcHandler,
+        plugin: FakePlugin,
+        clock: FrozenClock,
+    ) -> None:
+        hold_invoice, htlc, request = add_pending_htlc(handler)
+
+        clock.now = NOW + timedelta(seconds=TIMEOUT_CANCEL) - timedelta(microseconds=1)
+        handler._timeout_handler()  # noqa: SLF001
+
+        assert htlc.state == HtlcState.Accepted
+        assert request.result is None
+        assert len(handler._expiries) == 1  # noqa: SLF001
+
+        clock.now = NOW + timedelta(seconds=TIMEOUT_CANCEL)
+        handler._timeout_handler()  # noqa: SLF001
+
+        assert htlc.state == HtlcState.Cancelled
+        assert request.result == {
+            "result": "fail",
+            "failure_message": HtlcFailureMessage.MppTimeout.value,
+        }
+        assert len(handler._expiries) == 0  # noqa: SLF001
+
+        handler._ds.flush()  # noqa: SLF001
+        stored = plugin.rpc.stored_invoice(hold_invoice.payment_hash)
+        assert stored.htlcs.htlcs[0].state == HtlcState.Cancelled
+
+    @pytest.mark.parametrize(
+        "state",
+        [InvoiceState.Accepted, InvoiceState.Paid, InvoiceState.Cancelled],
+    )
+    def test_stale_entries_dropped(
+        self,
+        handler: HtlcHandler,
+        plugin: FakePlugin,
+        clock: FrozenClock,
+        state: InvoiceState,
+    ) -> None:
+        hold_invoice, htlc, request = add_pending_htlc(handler, state)
+        writes = len(plugin.rpc.writes)
+
+        clock.now = NOW + timedelta(seconds=TIMEOUT_CANCEL * 2)
+        handler._timeout_handler()  # noqa: SLF001
+
+        assert len(handler._expiries) == 0  # noqa: SLF001
+        assert htlc.state == HtlcState.Accepted
+        assert request.result is None
+        assert hold_invoice.payment_hash not in handler._ds._dirty  # noqa: SLF001
+        assert len(plugin.rpc.writes) == writes
+
+    def test_wait_capped_at_check_interval(
+        self,
+        handler: HtlcHandler,
+        clock: FrozenClock,  # noqa: ARG002
+    ) -> None:
+        assert handler._next_expiry_wait() == TIMEOUT_CHECK_INTERVAL  # noqa: SLF001
+
+        add_pending_htlc(handler)
+        assert TIMEOUT_CANCEL > TIMEOUT_CHECK_INTERVAL
+        assert handler._next_expiry_wait() == TIMEOUT_CHECK_INTERVAL  # noqa: SLF001
+
+    def test_wait_until_next_expiry(self, handler: HtlcHandler, clock: FrozenClock) -> None:
+        add_pending_htlc(handler)
+
+        clock.now = NOW + timedelta(seconds=TIMEOUT_CANCEL - 3)
+        assert handler._next_expiry_wait() == 3  # noqa: SLF001
+
+    def test_expired_top_entry(self, handler: HtlcHandler, clock: FrozenClock) -> None:
+        add_pending_htlc(handler, InvoiceState.Paid)
+
+        clock.now = NOW + timedelta(seconds=TIMEOUT_CANCEL + 1)
+        assert handler._next_expiry_wait() == 0  # noqa: SLF001
+
+        # The entry is popped even though its invoice is skipped,
+        # so the next wait does not spin on it
+        handler._timeout_handler()  # noqa: SLF001
+        assert handler._next_expiry_wait() == TIMEOUT_CHECK_INTERVAL  # noqa: SLF001
+
+
+class TestLocks:
+    def test_lock_stable_per_payment_hash(self, handler: HtlcHandler) -> None:
+        payment_hashes = [random.randbytes(32).hex() for _ in range(256)]
+        locks = [handler.lock(payment_hash) for payment_hash in payment_hashes]
+
+        for payment_hash, lock in zip(payment_hashes, locks, strict=True):
+            assert handler.lock(payment_hash) is lock
+
+            # Equal strings that are different objects map to the same lock
+            assert handler.lock("".join(payment_hash)) is lock
+
+        assert all(any(lock is shard for shard in handler._locks) for lock in locks)  # noqa: SLF001
+        assert len({id(lock) for lock in locks}) > 1
+
+
+class TestHtlcFailure:
+    def test_fail_htlc_that_raised(
+        self,
+        handler: HtlcHandler,
+        plugin: FakePlugin,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        hold_invoice = create_hold_invoice()
+        handler._ds.save_invoice(hold_invoice)  # noqa: SLF001
+
+        fail_next_save(handler, monkeypatch)
+        request = FakeRequest()
+        handler._process_htlc(  # noqa: SLF001
+            htlc_dict(hold_invoice.payment_hash, 0),
+            {"payment_secret": hold_invoice.payment_secret},
+            request,
+        )
+
+        assert request.result == {
+            "result": "fail",
+            "failure_message": HtlcFailureMessage.IncorrectPaymentDetails.value,
+        }
+        assert hold_invoice.state == InvoiceState.Unpaid
+        assert [htlc.state for htlc in hold_invoice.htlcs.htlcs] == [HtlcState.Cancelled]
+        assert (
+            handler._settler.find_htlc_request(  # noqa: SLF001
+                hold_invoice.payment_hash, hold_invoice.htlcs.htlcs[0]
+            )
+            is None
+        )
+
+        handler._ds.flush()  # noqa: SLF001
+        stored = plugin.rpc.stored_invoice(hold_invoice.payment_hash)
+        assert stored.state == InvoiceState.Unpaid
+        assert [htlc.state for htlc in stored.htlcs.htlcs] == [HtlcState.Cancelled]
+
+    def test_fail_htlc_that_completed_payment(
+        self,
+        handler: HtlcHandler,
+        plugin: FakePlugin,
+        clock: FrozenClock,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        hold_invoice = create_hold_invoice(amount_msat=2_000)
+        handler._ds.save_invoice(hold_invoice)  # noqa: SLF001
+        onion = {"payment_secret": hold_invoice.payment_secret}
+
+        pending_request = FakeRequest()
+        handler._process_htlc(  # noqa: SLF001
+            htlc_dict(hold_invoice.payment_hash, 0),
+            onion,
+            pending_request,
+        )
+
+        # Drop the expiry of the pending HTLC like a sweep while the invoice is accepted would
+        handler._expiries.clear()  # noqa: SLF001
+        clock.now = NOW + timedelta(seconds=1)
+
+        fail_next_save(handler, monkeypatch)
+        failed_request = FakeRequest()
+        handler._process_htlc(  # noqa: SLF001
+            htlc_dict(hold_invoice.payment_hash, 1),
+            onion,
+            failed_request,
+        )
+
+        assert failed_request.result == {
+            "result": "fail",
+            "failure_message": HtlcFailureMessage.IncorrectPaymentDetails.value,
+        }
+
+        # Only the HTLC whose handling raised is failed
+        pending, failed = hold_invoice.htlcs.htlcs
+        assert pending_request.result is None
+        assert pending.state == HtlcState.Accepted
+        assert failed.state == HtlcState.Cancelled
+
+        settler = handler._settler  # noqa: SLF001
+        assert settler.find_htlc_request(hold_invoice.payment_hash, pending) is pending_request
+        assert settler.find_htlc_request(hold_invoice.payment_hash, failed) is None
+
+        # The invoice is not fully paid anymore and its pending HTLC can time out again
+        assert hold_invoice.state == InvoiceState.Unpaid
+        assert hold_invoice.sum_paid() == 1_000
+        assert (
+            NOW + timedelta(seconds=TIMEOUT_CANCEL),
+            hold_invoice.payment_hash,
+        ) in handler._expiries  # noqa: SLF001
+
+        handler._ds.flush()  # noqa: SLF001
+        assert plugin.rpc.stored_invoice(hold_invoice.payment_hash).state == InvoiceState.Unpaid
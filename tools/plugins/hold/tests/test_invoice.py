@@ -0,0 +1,133 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from plugins.hold.enums import HtlcState, InvoiceState
+from plugins.hold.invoice import HoldInvoice, HoldInvoiceStateError, Htlcs
+from plugins.hold.tests.utils import create_hold_invoice, create_htlc
+from plugins.hold.utils import time_now
+
+
+class TestHtlcs:
+    def test_cancel_expired(self) -> None:
+        htlcs = Htlcs()
+        now = time_now()
+        htlcs.add_htlc(create_htlc(0, created_at=now - timedelta(seconds=120)))
+        htlcs.add_htlc(create_htlc(1, created_at=now - timedelta(seconds=10)))
+        htlcs.add_htlc(
+            create_htlc(2, state=HtlcState.Cancelled, created_at=now - timedelta(seconds=120))
+        )
+
+        expired = htlcs.cancel_expired(60)
+
+        assert [htlc.channel_id for htlc in expired] == [0]
+        assert [htlc.state for htlc in htlcs.htlcs] == [
+            HtlcState.Cancelled,
+            HtlcState.Accepted,
+            HtlcState.Cancelled,
+        ]
+
+    def test_sum_paid(self) -> None:
+        htlcs = Htlcs()
+        htlcs.add_htlc(create_htlc(0, msat=1_000))
+        htlcs.add_htlc(create_htlc(1, msat=2_000, state=HtlcState.Paid))
+        htlcs.add_htlc(create_htlc(2, msat=4_000, state=HtlcState.Cancelled))
+
+        assert htlcs.sum_paid() == 3_000
+
+    def test_sum_paid_state_changes(self) -> None:
+        htlcs = Htlcs()
+        htlc = create_htlc(0, msat=1_000)
+        htlcs.add_htlc(htlc)
+
+        htlcs.set_htlc_state(htlc, HtlcState.Paid)
+        assert htlcs.sum_paid() == 1_000
+
+        htlcs.set_htlc_state(htlc, HtlcState.Cancelled)
+        assert htlcs.sum_paid() == 0
+
+        htlcs.set_htlc_state(htlc, HtlcState.Cancelled)
+        assert htlcs.sum_paid() == 0
+
+    def test_sum_paid_from_json(self) -> None:
+        htlcs = Htlcs()
+        htlcs.add_htlc(create_htlc(0, msat=1_000))
+        htlcs.add_htlc(create_htlc(1, msat=4_000, state=HtlcState.Cancelled))
+
+        parsed = Htlcs.from_json_arr(json.loads(json.dumps([h.to_dict() for h in htlcs.htlcs])))
+        assert parsed.sum_paid() == 1_000
+
+
+class TestHoldInvoice:
+    @pytest.mark.parametrize("escaped", [False, True])
+    def test_from_json_legacy_format(self, escaped: bool) -> None:
+        data = json.dumps(
+            {
+                "state": "accepted",
+                "payment_preimage": None,
+                "created_at": 1697995743,
+                "payment_hash": "e3e9513787fae9478704447fc954cbd1de61299f4656f2b5afb7d1a02628d3be",
+                "bolt11": "lnbcrt12323230p1pjn2k7lsp57u9d0zghvyenzmxtk4xzq2yjkgj3hspcg82jzp0szvyyqnl0cekspp5u054zdu8lt550pcyg3luj4xt680xz2vlget09dd0klg6qf3g6wlqdqqcqzzs9qxpqysgqlnxpq3fd0g9wsfvpmd0anlc6n6umef9v48wjgw8myp4c9fgsf68nt4hchp9v62s8ppqxa858gk4yyats6unr2nhv2r9jntu5sj79xxcpugvr9l",  # noqa: E501
+                "htlcs": [
+                    {
+                        "state": "accepted",
+                        "short_channel_id": "811x1x0",
+                        "channel_id": 0,
+                        "msat": 1232323,
+                        "created_at": 1697995750,
+                    }
+                ],
+            }
+        )
+        if escaped:
+            data = "\\" + data.removesuffix("}") + "\\}"
+
+        invoice = HoldInvoice.from_json(data)
+
+        assert invoice.amount_msat == 1232323
+        assert invoice.min_final_cltv_expiry == 80
+        assert (
+            invoice.payment_secret
+            == "f70ad789176133316ccbb54c202892b2251bc03841d52105f01308404fefc66d"  # noqa: S105
+        )
+        assert invoice.state is InvoiceState.Accepted
+        assert invoice.created_at == datetime.fromtimestamp(1697995743, tz=timezone.utc)
+        assert invoice.htlcs.htlcs[0].state is HtlcState.Accepted
+        assert invoice.sum_paid() == 1232323
+        assert invoice.is_fully_paid()
+
+    def test_json_round_trip(self) -> None:
+        invoice = create_hold_invoice(
+            state=InvoiceState.Accepted,
+            htlcs=[
+                create_htlc(0, msat=1_000),
+                create_htlc(1, msat=4_000, state=HtlcState.Cancelled),
+            ],
+        )
+
+        parsed = HoldInvoice.from_json(invoice.to_json())
+
+        assert parsed.to_dict() == invoice.to_dict()
+        assert isinstance(parsed.state, InvoiceState)
+        assert all(isinstance(htlc.state, HtlcState) for htlc in parsed.htlcs.htlcs)
+        assert parsed.sum_paid() == 1_000
+
+    def test_to_dict_plain_states(self) -> None:
+        invoice_dict = create_hold_invoice(htlcs=[create_htlc(0)]).to_dict()
+
+        assert not isinstance(invoice_dict["state"], InvoiceState)
+        assert invoice_dict["state"] == "unpaid"
+        assert not isinstance(invoice_dict["htlcs"][0]["state"], HtlcState)
+        assert invoice_dict["htlcs"][0]["state"] == "accepted"
+
+    def test_check_state_transition(self) -> None:
+        invoice = create_hold_invoice()
+
+        invoice.check_state_transition(InvoiceState.Unpaid)
+        invoice.check_state_transition(InvoiceState.Accepted)
+
+        with pytest.raises(HoldInvoiceStateError):
+            invoice.check_state_transition(InvoiceState.Paid)
+
+        assert invoice.state == InvoiceState.Unpaid
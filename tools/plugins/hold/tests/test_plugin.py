@@ -229,6 +229,10 @@ class TestHold:
             format_json([PLUGIN_NAME, "invoices", data["payment_hash"]]),
         )
 
+        # Invoices are read from the datastore when the plugin starts
+        stop_plugin(cln)
+        start_plugin(cln)
+
         invoices = cln("listholdinvoices", data["payment_hash"])["holdinvoices"]
         assert len(invoices) == 1
         assert invoices[0]["amount_msat"] == 1232323
@@ -423,6 +427,13 @@ class TestHold:
         assert res["code"] == 2102
         assert res["message"] == "hold invoice with that payment hash does not exist"
 
+    @pytest.mark.parametrize("length", [16, 31, 33, 64])
+    def test_settle_invalid_payment_preimage_length(self, cln: CliCaller, length: int) -> None:
+        res = cln("settleholdinvoice", random.randbytes(length).hex())
+
+        assert res["code"] == 2105
+        assert res["message"] == "invalid payment preimage length"
+
     def test_cancel_unpaid(self, cln: CliCaller) -> None:
         payment_hash = random.randbytes(32).hex()
         cln("holdinvoice", payment_hash, "100000")
@@ -1,13 +1,18 @@
 import json
 import os
 from collections.abc import Callable
+from datetime import datetime
 from enum import Enum
 from threading import Thread
 from typing import Any
 
 import pytest
+from pyln.client import RpcError
 
-from plugins.hold.utils import parse_time
+from plugins.hold.consts import PLUGIN_NAME
+from plugins.hold.enums import HtlcState, InvoiceState
+from plugins.hold.invoice import HoldInvoice, Htlc, Htlcs
+from plugins.hold.utils import json_dumps, json_loads, parse_time, time_now
 
 PLUGIN_PATH = "/root/hold.sh"
 PLUGIN_PATH_MPAY = "/root/mpay.sh"
@@ -57,6 +62,113 @@ class RpcPlugin:
     rpc = RpcCaller()
 
 
+def create_htlc(
+    channel_id: int = 0,
+    msat: int = 1_000,
+    state: HtlcState = HtlcState.Accepted,
+    created_at: datetime | None = None,
+) -> Htlc:
+    return Htlc(
+        state=state,
+        short_channel_id="811x1x0",
+        channel_id=channel_id,
+        msat=msat,
+        created_at=created_at if created_at is not None else time_now(),
+    )
+
+
+def create_hold_invoice(
+    payment_hash: str = "11" * 32,
+    amount_msat: int = 1_000,
+    state: InvoiceState = InvoiceState.Unpaid,
+    htlcs: list[Htlc] | None = None,
+    created_at: datetime | None = None,
+) -> HoldInvoice:
+    invoice_htlcs = Htlcs()
+    for htlc in htlcs or []:
+        invoice_htlcs.add_htlc(htlc)
+
+    return HoldInvoice(
+        state=state,
+        bolt11="lnbcrt1",
+        amount_msat=amount_msat,
+        min_final_cltv_expiry=80,
+        payment_secret="00" * 32,
+        payment_hash=payment_hash,
+        payment_preimage=None,
+        created_at=created_at if created_at is not None else time_now(),
+        htlcs=invoice_htlcs,
+    )
+
+
+def datastore_error(code: int) -> RpcError:
+    return RpcError("datastore", {}, {"code": code, "message": f"datastore error {code}"})
+
+
+class FakeDatastoreRpc:
+    """In-memory stand-in for the datastore RPC methods of CLN."""
+
+    def __init__(self) -> None:
+        self.store: dict[tuple[str, ...], str] = {}
+        self.writes: list[dict[str, Any]] = []
+
+    def call(self, method: str, payload: dict[str, Any] | None = None) -> dict[str, Any]:
+        return getattr(self, method)(**(payload or {}))
+
+    def stored_invoice(self, payment_hash: str) -> HoldInvoice:
+        return HoldInvoice.from_json(self.store[(PLUGIN_NAME, "invoices", payment_hash)])
+
+    def listdatastore(self, key: list[str]) -> dict[str, Any]:
+        return {
+            "datastore": [
+                {"key": list(entry_key), "string": string}
+                for entry_key, string in self.store.items()
+                if list(entry_key[: len(key)]) == key
+            ]
+        }
+
+    def datastore(self, key: list[str], string: str, mode: str) -> dict[str, Any]:
+        entry_key = tuple(key)
+        if mode == "must-create" and entry_key in self.store:
+            raise datastore_error(1202)
+        if mode == "must-replace" and entry_key not in self.store:
+            raise datastore_error(1203)
+
+        self.store[entry_key] = string
+        self.writes.append(json.loads(string))
+        return {"key": key, "string": string}
+
+    def deldatastore(self, key: list[str]) -> dict[str, Any]:
+        entry_key = tuple(key)
+        if entry_key not in self.store:
+            raise datastore_error(1200)
+
+        return {"key": key, "string": self.store.pop(entry_key)}
+
+
+class FakePlugin:
+    def __init__(self) -> None:
+        self.rpc = FakeDatastoreRpc()
+        self.logs: list[tuple[str, str]] = []
+
+    def log(self, message: str, level: str = "info") -> None:
+        self.logs.append((level, message))
+
+
+class FakeRequest:
+    """Stand-in for the pyln request of an htlc_accepted hook call."""
+
+    def __init__(self) -> None:
+        self.result: dict[str, Any] | None = None
+
+    def set_result(self, result: dict[str, Any]) -> None:
+        if self.result is not None:
+            msg = "request was resolved already"
+            raise ValueError(msg)
+
+        self.result = result
+
+
 class LndNode(Enum):
     One = 1
     Two = 2
@@ -161,3 +273,9 @@ class TestUtils:
     )
     def test_parse_time(self, data: str, result: int) -> None:
         assert parse_time(data) == result
+
+    def test_json_compatible_with_stdlib(self) -> None:
+        data = {"state": "paid", "payment_preimage": None, "htlcs": [{"msat": 1_000}]}
+
+        assert json.loads(json_dumps(data)) == data
+        assert json_loads(json.dumps(data)) == data
@@ -4,7 +4,6 @@ from bolt11.models.routehint import Route, RouteHint
 
 from plugins.hold import router
 from plugins.hold.enums import HtlcState, InvoiceState
-from plugins.hold.invoice import HoldInvoice, Htlc
 from plugins.hold.protos.hold_pb2 import (
     HTLC_ACCEPTED,
     HTLC_CANCELLED,
@@ -46,25 +45,25 @@ PAY_STATUS_STATE_TO_GRPC = {
 
 class Transformers:
     @staticmethod
-    def invoice_to_grpc(invoice: HoldInvoice) -> Invoice:
+    def invoice_to_grpc(invoice: dict[str, Any]) -> Invoice:
         return Invoice(
-            payment_hash=invoice.payment_hash,
-            payment_preimage=invoice.payment_preimage,
-            state=INVOICE_STATE_TO_GRPC[invoice.state],
-            bolt11=invoice.bolt11,
-            amount_msat=invoice.amount_msat,
-            created_at=int(invoice.created_at.timestamp()),
-            htlcs=[Transformers.htlc_to_grpc(htlc) for htlc in invoice.htlcs.htlcs],
+            payment_hash=invoice["payment_hash"],
+            payment_preimage=invoice["payment_preimage"],
+            state=INVOICE_STATE_TO_GRPC[invoice["state"]],
+            bolt11=invoice["bolt11"],
+            amount_msat=invoice["amount_msat"],
+            created_at=invoice["created_at"],
+            htlcs=[Transformers.htlc_to_grpc(htlc) for htlc in invoice["htlcs"]],
         )
 
     @staticmethod
-    def htlc_to_grpc(htlc: Htlc) -> HtlcGrpc:
+    def htlc_to_grpc(htlc: dict[str, Any]) -> HtlcGrpc:
         return HtlcGrpc(
-            state=HTLC_STATE_TO_GRPC[htlc.state],
-            msat=htlc.msat,
-            created_at=int(htlc.created_at.timestamp()),
-            short_channel_id=htlc.short_channel_id,
-            id=htlc.channel_id,
+            state=HTLC_STATE_TO_GRPC[htlc["state"]],
+            msat=htlc["msat"],
+            created_at=htlc["created_at"],
+            short_channel_id=htlc["short_channel_id"],
+            id=htlc["channel_id"],
         )
 
     @staticmethod
@@ -1,6 +1,27 @@
+import json
 from collections.abc import Callable
 from datetime import datetime, timezone
-from typing import TypeVar
+from typing import Any
+
+# orjson is a faster drop-in for the JSON of the datastore; the stdlib is the fallback
+# for environments without it. Both are bound once, since they are called for every write
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_dumps: Callable[[Any], str]
+json_loads: Callable[[str], Any]
+
+if orjson is not None:
+
+    def json_dumps(obj: Any) -> str:  # noqa: ANN401
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 
 def time_now() -> datetime:
@@ -12,19 +33,3 @@ def parse_time(time: str) -> int:
         return int(datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp())
     except ValueError:
         return 0
-
-
-T = TypeVar("T")
-
-
-def partition(iterable: list[T], pred: Callable[[T], bool]) -> tuple[list[T], list[T]]:
-    trues = []
-    falses = []
-
-    for item in iterable:
-        if pred(item):
-            trues.append(item)
-        else:
-            falses.append(item)
-
-    return trues, falses